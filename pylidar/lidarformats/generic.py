@@ -168,6 +168,14 @@ class PulseRange(object):
         return (self.startPulse != other.startPulse or
                 self.endPulse != other.endPulse)
 
+    def copy(self):
+        """
+        Return a copy of this range. Faster than copy.copy() as it
+        avoids the generic copy protocol - this gets called once per
+        block during processing.
+        """
+        return PulseRange(self.startPulse, self.endPulse)
+
 class LiDARFile(basedriver.Driver):
     """
     Base class for all LiDAR Format reader/writers.
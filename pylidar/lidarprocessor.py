@@ -22,6 +22,12 @@ And the doProcessing function itself
 from __future__ import print_function, division
 
 import os
+import threading
+try:
+    import queue
+except ImportError:
+    # python 2
+    import Queue as queue
 import numpy
 from rios import imageio
 from rios import pixelgrid
@@ -102,6 +108,11 @@ Controls.setMessageHandler
 DEFAULT_WINDOW_SIZE = 256 # bins
 "Size of the default window size in bins"
 
+BLOCK_ORDER_RASTER = 0
+"to be passed to Controls.setBlockOrder()"
+BLOCK_ORDER_MORTON = 1
+"to be passed to Controls.setBlockOrder()"
+
 ARRAY_TYPE_POINTS = generic.ARRAY_TYPE_POINTS
 """
 For use in userclass.LidarData.translateFieldNames() and 
@@ -253,9 +264,16 @@ def silentMessageFn(message, level):
     
 class Controls(object):
     """
-    The controls object. This is passed to the doProcessing function 
+    The controls object. This is passed to the doProcessing function
     and contains methods for controling the behaviour of the processing.
     """
+    # no __dict__ - slightly faster attribute access and catches typos
+    # in option names early
+    __slots__ = ('footprint', 'windowSize', 'overlap', 'spatialProcessing',
+        'referenceImage', 'referencePixgrid', 'referenceResolution',
+        'snapGrid', 'progress', 'messageHandler', 'ioDepth',
+        'maxPointsPerBlock', 'blockOrder', 'writeBatchSize')
+
     def __init__(self):
         self.footprint = INTERSECTION
         self.windowSize = DEFAULT_WINDOW_SIZE
@@ -267,7 +285,11 @@ class Controls(object):
         self.snapGrid = False
         self.progress = cuiprogress.SilentProgress()
         self.messageHandler = defaultMessageFn
-        
+        self.ioDepth = 0
+        self.maxPointsPerBlock = None
+        self.blockOrder = BLOCK_ORDER_RASTER
+        self.writeBatchSize = 0
+
     def setFootprint(self, footprint):
         """
         Set the footprint of the processing area. This should be
@@ -382,14 +404,150 @@ class Controls(object):
         function that takes a message string and a level (one of the
         MESSAGE_* constants).
         """
-        self.messageHandler = messageHandler        
-    
+        self.messageHandler = messageHandler
+
+    def setWriteBatchSize(self, nBytes):
+        """
+        Accumulate output across blocks and write it in larger chunks.
+        When greater than zero, data queued with setPoints/setPulses on
+        files created in non-spatial mode is held until roughly nBytes
+        have built up (or processing finishes) and then written with a
+        single driver call. Many small writes per block become a few
+        large ones, which cuts file system and HDF5 chunk-compression
+        overhead when blocks produce little data.
+
+        The default of 0 writes every block as before. Only plain 1d
+        pulse arrays (with optional 2d points-by-pulse arrays) can be
+        combined - waveform data, spatial processing and UPDATE mode
+        always flush per block. Ignored when setIODepth() is in use as
+        those writes already bypass the normal flush path.
+        """
+        self.writeBatchSize = nBytes
+
+    def setBlockOrder(self, blockOrder):
+        """
+        Set the order the blocks are visited in when doing spatial
+        processing. Either BLOCK_ORDER_RASTER (the default, left to right
+        then top to bottom) or BLOCK_ORDER_MORTON which walks the blocks
+        along a Morton (Z-order) curve. Successive blocks on the Morton
+        curve are spatial neighbours, so overlap regions and spatial
+        index pages are much more likely to still be in the OS file cache
+        when they are needed again.
+
+        The set of blocks processed is identical either way - only the
+        order changes - so results are unaffected.
+        """
+        self.blockOrder = blockOrder
+
+    def setMaxPointsPerBlock(self, maxPoints):
+        """
+        Cap the expected number of pulses read per block when doing
+        spatial processing. The processing window is automatically
+        shrunk below setWindowSize() so that, at the average pulse
+        density of the input files, each block holds no more than
+        maxPoints pulses. This bounds peak memory on dense captures
+        without having to hand-tune the window size per file.
+
+        Pass None (the default) to disable and always use the window
+        size as set. Ignored when the drivers cannot report their total
+        pulse count.
+        """
+        self.maxPointsPerBlock = maxPoints
+
+    def setIODepth(self, ioDepth):
+        """
+        Set the depth of the output write queue. When greater than zero,
+        writes to files opened in CREATE mode are done on a background
+        thread so that writing block N overlaps with reading and
+        processing block N+1. A depth of 2 is usually enough. The queue is
+        bounded so at most ioDepth blocks of output are held in memory.
+
+        The default of 0 keeps all writes synchronous. Files opened in
+        UPDATE mode are always written synchronously since they are also
+        read in the main thread.
+        """
+        self.ioDepth = ioDepth
+
+def _mortonCode(x, y):
+    """
+    Return the Morton (Z-order) code for integer block coordinates
+    (x, y) by interleaving the bits of each.
+    """
+    z = 0
+    for i in range(32):
+        z |= ((x >> i) & 1) << (2 * i)
+        z |= ((y >> i) & 1) << (2 * i + 1)
+    return z
+
+class _BackgroundWriter(object):
+    """
+    Runs driver writes on a background thread, fed by a bounded queue.
+    Used by doProcessing() when Controls.setIODepth() is given a depth
+    greater than zero. Only drivers opened in CREATE mode go through
+    here - they are never read, so the writer thread is the only thing
+    touching them.
+    """
+    def __init__(self, depth):
+        self.jobQueue = queue.Queue(maxsize=depth)
+        self.exception = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobQueue.get()
+            if job is None:
+                self.jobQueue.task_done()
+                break
+            try:
+                # once something has gone wrong just drain the queue -
+                # the exception is re-raised in the main thread
+                if self.exception is None:
+                    (driver, extent, data) = job
+                    if extent is not None:
+                        driver.setExtent(extent)
+                    if isinstance(driver, gdaldriver.GDALDriver):
+                        driver.setData(data)
+                    else:
+                        driver.writeData(*data)
+            except Exception as e:
+                self.exception = e
+            finally:
+                self.jobQueue.task_done()
+
+    def put(self, driver, extent, data):
+        """
+        Queue one block of output for the given driver. extent should be
+        a copy (or None for non-spatial processing). Blocks if the queue
+        is full. Re-raises any exception from earlier writes.
+        """
+        self.raiseIfError()
+        self.jobQueue.put((driver, extent, data))
+
+    def raiseIfError(self):
+        if self.exception is not None:
+            e = self.exception
+            self.exception = None
+            raise e
+
+    def finish(self):
+        """
+        Wait for all queued writes to complete and stop the thread.
+        """
+        self.jobQueue.put(None)
+        self.thread.join()
+        self.raiseIfError()
+
 class LidarFile(object):
     """
     Create an instance of this to process a LiDAR file. Set it to a 
     field within your instance of DataFiles.
     The mode is one of: READ, UPDATE or CREATE.
     """
+    __slots__ = ('fname', 'mode', 'lidarDriver', 'lidarDriverOptions',
+        'writeSpatialIndex')
+
     def __init__(self, fname, mode):
         self.fname = fname
         self.mode = mode
@@ -421,6 +579,9 @@ class LidarFile(object):
         
     
 class ImageFile(object):
+    __slots__ = ('fname', 'mode', 'rasterDriver', 'rasterDriverOptions',
+        'rasterIgnore')
+
     def __init__(self, fname, mode):
         self.fname = fname
         self.mode = mode
@@ -501,36 +662,82 @@ To suppress this message call Controls.setSpatialProcessing(False)"""
                 raise generic.LiDARFileException(msg)
 
 
+    # set up the background writer if requested. Only files opened in
+    # CREATE mode can be written asynchronously since they are never
+    # read; fall back to synchronous writes if anything is opened for
+    # update as those drivers are read in the main thread.
+    bgWriter = None
+    if controls.ioDepth > 0:
+        anyUpdate = any([driver.mode == generic.UPDATE
+                        for driver in driverList])
+        if anyUpdate:
+            msg = 'Asynchronous writes disabled - file(s) opened in UPDATE mode'
+            controls.messageHandler(msg, MESSAGE_WARNING)
+        else:
+            bgWriter = _BackgroundWriter(controls.ioDepth)
+
     # set up depending on if spatial or non spatial processing
     if controls.spatialProcessing:
         
-        workingPixGrid = getWorkingPixGrid(controls, userContainer, 
+        workingPixGrid = getWorkingPixGrid(controls, userContainer,
                                 gridList, driverList)
-            
+
+        # work out number of pixels of workingPixGrid - allow
+        # rounding error of up to half a pixel by using round
+        xsize = numpy.round((workingPixGrid.xMax - workingPixGrid.xMin) /
+                        workingPixGrid.xRes)
+        ysize = numpy.round((workingPixGrid.yMax - workingPixGrid.yMin) /
+                        workingPixGrid.yRes)
+
+        windowSize = controls.windowSize
+        if controls.maxPointsPerBlock is not None:
+            # shrink the window so that, at the average pulse density over
+            # the full extent, a block is expected to hold no more than
+            # maxPointsPerBlock pulses. Caps peak memory on dense files.
+            try:
+                nTotalPulses = max([driver.getTotalNumberPulses()
+                            if driver.mode != generic.CREATE else -1
+                            for driver in driverList])
+            except generic.LiDARFunctionUnsupported:
+                # can't estimate the density so leave the window alone
+                nTotalPulses = -1
+            if nTotalPulses > 0:
+                density = nTotalPulses / (xsize * ysize) # pulses per bin
+                newSize = int(numpy.sqrt(controls.maxPointsPerBlock / density))
+                if newSize < 1:
+                    newSize = 1
+                if newSize < windowSize:
+                    windowSize = newSize
+                    msg = ('Reduced processing window size to %d bins to '
+                        'stay under maxPointsPerBlock' % windowSize)
+                    controls.messageHandler(msg, MESSAGE_INFORMATION)
+
         # work out where the first block is
-        # controls.windowSize is in bins. Convert to meters
-        windowSizeWorld = controls.windowSize * workingPixGrid.xRes
-        currentExtent = basedriver.Extent(workingPixGrid.xMin, 
+        # windowSize is in bins. Convert to meters
+        windowSizeWorld = windowSize * workingPixGrid.xRes
+        currentExtent = basedriver.Extent(workingPixGrid.xMin,
                         workingPixGrid.xMin + windowSizeWorld,
                         workingPixGrid.yMax - windowSizeWorld,
                         workingPixGrid.yMax, workingPixGrid.xRes)
-                        
+
         # handle the file being smaller than the block size
         if currentExtent.xMax > workingPixGrid.xMax:
             currentExtent.xMax = workingPixGrid.xMax
         if currentExtent.yMin < workingPixGrid.yMin:
             currentExtent.yMin = workingPixGrid.yMin
 
-        # work out number of pixels of workingPixGrid - allow 
-        # rounding error of up to half a pixel by using round
-        xsize = numpy.round((workingPixGrid.xMax - workingPixGrid.xMin) / 
-                        workingPixGrid.xRes)
-        ysize = numpy.round((workingPixGrid.yMax - workingPixGrid.yMin) /
-                        workingPixGrid.yRes)
-
         # now work out total blocks - ceil() allows for partial blocks
-        xtotalblocks = int(numpy.ceil(xsize / controls.windowSize))
-        ytotalblocks = int(numpy.ceil(ysize / controls.windowSize))
+        xtotalblocks = int(numpy.ceil(xsize / windowSize))
+        ytotalblocks = int(numpy.ceil(ysize / windowSize))
+
+        # when requested, visit the blocks along a Morton curve rather
+        # than in raster order. The curve starts at (0, 0) so the first
+        # extent set up above is still the first block.
+        blockOrderList = None
+        if controls.blockOrder == BLOCK_ORDER_MORTON:
+            blockOrderList = [(x, y) for y in range(ytotalblocks)
+                                for x in range(xtotalblocks)]
+            blockOrderList.sort(key=lambda xy: _mortonCode(xy[0], xy[1]))
         nTotalBlocks = xtotalblocks * ytotalblocks
         bMoreToDo = currentExtent.yMax > workingPixGrid.yMin
         
@@ -562,7 +769,10 @@ To suppress this message call Controls.setSpatialProcessing(False)"""
         # update the driver classes with the new extent
         if controls.spatialProcessing:
             for driver in driverList:
-                driver.setExtent(currentExtent)
+                # when writing in the background the writer thread sets
+                # the extent on the output drivers just before each write
+                if bgWriter is None or driver.mode != generic.CREATE:
+                    driver.setExtent(currentExtent)
             # update info class
             userContainer.info.setExtent(currentExtent)
             # last block yet?
@@ -596,11 +806,20 @@ To suppress this message call Controls.setSpatialProcessing(False)"""
         if bMoreToDo:
             for name in dataFiles.__dict__.keys():
                 userClass = getattr(userContainer, name)
-                if isinstance(userClass, list):
-                    for userClassItem in userClass:
+                if not isinstance(userClass, list):
+                    userClass = [userClass]
+                for userClassItem in userClass:
+                    if (bgWriter is not None and
+                            userClassItem.mode == generic.CREATE):
+                        # hand the queued data to the writer thread so the
+                        # write overlaps with the next block
+                        extent = None
+                        if controls.spatialProcessing:
+                            extent = currentExtent.copy()
+                        bgWriter.put(userClassItem.driver, extent,
+                            userClassItem.popWriteData())
+                    else:
                         userClassItem.flush()
-                else:
-                    userClass.flush()
 
         # we have completed another one - this var is used below
         # for calculating block location
@@ -608,9 +827,13 @@ To suppress this message call Controls.setSpatialProcessing(False)"""
         
         if controls.spatialProcessing:
             # update to read in next block
-            # try going across first
-            xblock = nBlocksSoFar % xtotalblocks
-            yblock = nBlocksSoFar // xtotalblocks
+            if blockOrderList is not None:
+                (xblock, yblock) = blockOrderList[
+                    min(nBlocksSoFar, nTotalBlocks - 1)]
+            else:
+                # try going across first
+                xblock = nBlocksSoFar % xtotalblocks
+                yblock = nBlocksSoFar // xtotalblocks
             currentExtent.xMin = workingPixGrid.xMin + xblock * windowSizeWorld
             currentExtent.xMax = workingPixGrid.xMin + (xblock+1) * windowSizeWorld
             currentExtent.yMax = workingPixGrid.yMax - yblock * windowSizeWorld
@@ -638,7 +861,19 @@ To suppress this message call Controls.setSpatialProcessing(False)"""
             controls.progress.setProgress(percentProgress)
 
     controls.progress.reset()
-    
+
+    # write anything still held back by write batching
+    for name in dataFiles.__dict__.keys():
+        userClass = getattr(userContainer, name)
+        if not isinstance(userClass, list):
+            userClass = [userClass]
+        for userClassItem in userClass:
+            userClassItem.finalFlush()
+
+    # wait for any outstanding background writes before closing
+    if bgWriter is not None:
+        bgWriter.finish()
+
     # close all the files
     for driver in driverList:
         driver.close()
@@ -23,6 +23,62 @@ from __future__ import print_function, division
 import numpy
 from numba import jit
 
+class FieldDict(dict):
+    """
+    A dictionary of per-field contiguous arrays keyed by field name -
+    a 'struct of arrays' alternative to a numpy structured array.
+
+    Because each field is a densely packed array, per-field operations
+    (mean, digitize etc) run at full memory bandwidth rather than striding
+    through interleaved records.
+
+    Has a 'shape' attribute (shape of each field array) and a 'mask'
+    attribute which is either None or a bool array of the same shape
+    shared by all fields (True where invalid, same convention as
+    numpy.ma). Use view_structured() to get back a structured array.
+    """
+    def __init__(self, shape=None, mask=None):
+        dict.__init__(self)
+        self.shape = shape
+        self.mask = mask
+
+    def view_structured(self):
+        """
+        Stack the fields back into a structured array (masked if this
+        FieldDict has a mask). Note this copies the data.
+        """
+        dtype = [(name, self[name].dtype) for name in self]
+        structArray = numpy.empty(self.shape, dtype=dtype)
+        for name in self:
+            structArray[name] = self[name]
+
+        if self.mask is not None:
+            structArray = numpy.ma.MaskedArray(structArray, mask=self.mask)
+
+        return structArray
+
+def structArrayToFieldDict(structArray):
+    """
+    Convert a structured array (masked or not, such as those returned by
+    the LidarData.getPoints* functions) into a FieldDict of contiguous
+    per-field arrays.
+    """
+    isMasked = isinstance(structArray, numpy.ma.MaskedArray)
+    data = structArray.data if isMasked else structArray
+
+    mask = None
+    if isMasked:
+        # get first field so we can get the 'one mask value per element'
+        # kind of mask instead of the 'mask value per field'
+        firstField = structArray.dtype.names[0]
+        mask = structArray[firstField].mask
+
+    fields = FieldDict(shape=data.shape, mask=mask)
+    for name in data.dtype.names:
+        fields[name] = numpy.ascontiguousarray(data[name])
+
+    return fields
+
 def addFieldToStructArray(oldArray, newName, newType, newData=0):
     """
     Creates a new array with all the data from oldArray, but with a new
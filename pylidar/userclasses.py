@@ -22,12 +22,12 @@ from __future__ import print_function, division
 
 import copy
 import numpy
-from numba import jit
+from numba import jit, prange
 from .lidarformats import generic
 from .toolbox import arrayutils
 
-@jit
-def stratify3DArrayByValueIdx(inValues, inValuesMask, outIdxs_row, outIdxs_col, outIdxs_p, 
+@jit(nopython=True, nogil=True, cache=True)
+def stratify3DArrayByValueIdx(inValues, inValuesMask, outIdxs_row, outIdxs_col, outIdxs_p,
         outIdxsMask, outIdxsCount, 
         bins, counting):
     """
@@ -46,7 +46,11 @@ def stratify3DArrayByValueIdx(inValues, inValuesMask, outIdxs_row, outIdxs_col,
     * outIdxs_col      4d array of col coord of stratified values (nPtsPerHgtBin, nBins, nrows, ncols)
     * outIdxs_p        4d array of p coord (nPtsPerHgtBin, nBins, nrows, ncols)
     * outIdxsMask      4d bool array - True for unused elements (nPtsPerHgtBin, nBins, nrows, ncols)
-    * outIdxsCount     3d int array of counts per bin (nBins, rows, ncols) (initialized to zero, always)
+    * outIdxsCount     3d int array of counts per bin (nBins, rows, ncols) (initialized to zero, always).
+      Beware of overflow when choosing the dtypes - uint16 counts (and
+      uint16 outIdxs_* coords) silently wrap once a bin holds more than
+      65535 points, which dense captures can easily exceed. Use uint32
+      unless nPts is known to be < 65536.
     * bins             1d array of height bins. Includes end points, i.e. the number of height bins is
                      (len(bins) - 1). A point is in i-th bin when bin[i] <= z < bins[i+1]. Assumes
                      no points are outside the range of bin values given. 
@@ -79,56 +83,76 @@ def stratify3DArrayByValueIdx(inValues, inValuesMask, outIdxs_row, outIdxs_col,
                             # always update the counts
                             outIdxsCount[b, r, c] += 1
 
-@jit
-def stratify3DArrayByValue(inValues, inValuesMask, rebinnedByHeight, 
-        rebinnedByHeight_mask, outIdxsCount, 
+@jit(nopython=True, nogil=True, parallel=True, fastmath=True, cache=True)
+def stratify3DArrayByValue(inValues, inValuesMask, rebinnedByHeight,
+        rebinnedByHeight_mask, outIdxsCount,
         bins, counting, heightValues):
     """
-    Called by rebinPtsByHeight().
-    
-    Creates a new 4d (points, height bin, row, col) array if the 3d 
-    (points, row, col) data in inValues.
-    
+    Note: This function is no longer called since rebinPtsByHeight() now
+    does the stratification with pure numpy, but is kept in case it is
+    needed for building a spatial index in future.
+
+    Creates a new 4d (points, height bin, row, col) array if the 3d
+    (row, col, points) data in inValues.
+
     Parameters:
-    
-    * inValues         3d (ragged) structured array of values to stratify  (nPts, nrows, ncols)
+
+    * inValues         3d (ragged) structured array of values to stratify  (nrows, ncols, nPts).
+      Pass a C-contiguous array (ie numpy.ascontiguousarray(arr.transpose(1, 2, 0)) if you
+      have a (nPts, nrows, ncols) array) so the inner point loop reads consecutive memory.
     * inValuesMask     Mask for inValues - note this must be a plain bool array not just inValues.mask
       since inValues.mask will have a bool per record. Best to pass mask for a single
-      record - ie heightValues.mask.
+      record - ie heightValues.mask. Same (nrows, ncols, nPts) layout.
     * rebinnedByHeight 4d Output array (nPtsPerHgtBin, nBins, nrows, ncols)
     * rebinnedByHeight_mask 4d output mask for creating ragged array (should be inited to True).
-    * outIdxsCount     3d int array of counts per bin (nBins, rows, ncols) (initialized to zero, always)
+    * outIdxsCount     3d int array of counts per bin (nBins, rows, ncols) (initialized to zero, always).
+      Use uint32 (not uint16) unless nPts is known to be < 65536,
+      otherwise the counts silently wrap on dense data.
     * bins             1d array of height bins. Includes end points, i.e. the number of height bins is
       (len(bins) - 1). A point is in i-th bin when bin[i] <= z < bins[i+1]. Assumes
-      no points are outside the range of bin values given. 
+      no points are outside the range of bin values given.
     * counting         bool flag. If True, then we are just counting, and filling in outIdxsCount,
-      otherwise we are filling in inValues* arrays, too. 
+      otherwise we are filling in inValues* arrays, too.
     * heightValues    3d (ragged) array of a single value from inValues to stratify on ie inValues['Z'].
-                         
+      Same (nrows, ncols, nPts) layout.
+
     Returns:
 
     * Nothing
-    
+
     Usage: Call first with counting=True, then find outIdxsCount.max(), use this as nPtsPerHgtBin
-    to create other out arrays. Then zero outIdxsCount again, and call again with counting=False. 
-    
+    to create other out arrays. Then zero outIdxsCount again, and call again with counting=False.
+
+    Rows are processed in parallel (numba.prange) - each row writes to a
+    disjoint slice of the output arrays so no locking is needed.
+
     """
-    (nPts, nRows, nCols) = inValues.shape
+    (nRows, nCols, nPts) = inValues.shape
     nBins = bins.shape[0] - 1 # because they are bounds
-    for r in range(nRows):
+    for r in prange(nRows):
         for c in range(nCols):
             for p in range(nPts):
-                if not inValuesMask[p, r, c]: # because masked arrays are False where not masked
-                    v = heightValues[p, r, c]
-                    for b in range(nBins):
-                        if v >= bins[b] and v < bins[b+1]: # in this bin?
-                            if not counting:
-                                # only do these steps when running for real
-                                j = outIdxsCount[b, r, c]
-                                rebinnedByHeight[j, b, r, c] = inValues[p, r, c]
-                                rebinnedByHeight_mask[j, b, r, c] = False
-                            # always update the counts
-                            outIdxsCount[b, r, c] += 1
+                if not inValuesMask[r, c, p]: # because masked arrays are False where not masked
+                    v = heightValues[r, c, p]
+                    if v >= bins[0] and v < bins[nBins]: # in range?
+                        # binary search for the bin with
+                        # bins[b] <= v < bins[b+1]
+                        lo = 0
+                        hi = nBins
+                        while hi - lo > 1:
+                            mid = (lo + hi) >> 1
+                            if v >= bins[mid]:
+                                lo = mid
+                            else:
+                                hi = mid
+                        b = lo
+                        if not counting:
+                            # only do these steps when running for real
+                            j = outIdxsCount[b, r, c]
+                            rebinnedByHeight[j, b, r, c] = inValues[r, c, p]
+                            rebinnedByHeight_mask[j, b, r, c] = False
+                        # always update the counts
+                        outIdxsCount[b, r, c] += 1
 
 class UserInfo(object):
     """
@@ -137,8 +161,13 @@ class UserInfo(object):
     obtain information on the current processing state and region.
         
     Equivalent to the RIOS 'info' object.
-    
+
     """
+    # no __dict__ - instances are per-processing-run but the attributes
+    # are poked every block so keep access on the fast path
+    __slots__ = ('pixGrid', 'extent', 'range', 'firstBlock', 'lastBlock',
+        'controls')
+
     def __init__(self, controls):
         self.pixGrid = None
         self.extent = None # either extent is not None, or range. Not both.
@@ -181,8 +210,9 @@ class UserInfo(object):
         """
         For internal use. Used by the processor to set the current state.
         """
-        # take a copy so the user can't change it
-        self.extent = copy.copy(extent)
+        # take a copy so the user can't change it. Extent.copy() is much
+        # cheaper than copy.copy() and this happens every block.
+        self.extent = extent.copy()
         
     def getExtent(self):
         """
@@ -197,8 +227,9 @@ class UserInfo(object):
         """
         For internal use. Used by the processor to set the current state.
         """
-        # take a copy so the user can't change it
-        self.range = copy.copy(range)
+        # take a copy so the user can't change it. PulseRange.copy() is
+        # much cheaper than copy.copy() and this happens every block.
+        self.range = range.copy()
         
     def getRange(self):
         """
@@ -272,6 +303,17 @@ class LidarData(object):
         self.driver = driver
         self.extent = None
         self.controls = driver.controls
+        # cache of extracted fields for the current block. See getField().
+        self._fieldCache = {}
+        # cache of raw driver reads for the current block. See _readCached().
+        self._blockCache = {}
+        # reusable scratch buffers for rebinPtsByHeight. See _getRebinScratch().
+        self._rebinScratch = {}
+        # accumulated output when write batching is on. See flush().
+        self._batchedPulses = []
+        self._batchedPoints = []
+        self._batchedBytes = 0
+        self._batchedHasPoints = False
         # for writing
         self.pointsToWrite = None
         self.pulsesToWrite = None
@@ -306,21 +348,49 @@ class LidarData(object):
         # just for consistancy
         return array
         
+    def _readCached(self, key, readFn, *args):
+        """
+        Memoize a driver read for the current block. key identifies the
+        read (method name plus arguments), readFn does the actual read.
+        The cache is dropped at the end of each block (in flush()) so a
+        user function calling eg getPulses() then getPulsesByBins() does
+        not read the same data from the driver twice.
+        """
+        if key in self._blockCache:
+            return self._blockCache[key]
+
+        data = readFn(*args)
+        self._blockCache[key] = data
+        return data
+
+    @staticmethod
+    def _makeColNamesKey(colNames):
+        """
+        colNames can be None, a string or a list - make it hashable so it
+        can form part of a block cache key.
+        """
+        if isinstance(colNames, list):
+            return tuple(colNames)
+        return colNames
+
     def getPoints(self, colNames=None):
         """
         Returns the points for the extent/range of the current
         block as a structured array. The fields on this array
         are defined by the driver being used.
-        
+
         colNames can be a name or list of column names to return. By default
         all columns are returned.
         """
+        key = ('points', self._makeColNamesKey(colNames))
         if self.controls.spatialProcessing:
-            points = self.driver.readPointsForExtent(colNames)
+            points = self._readCached(key,
+                        self.driver.readPointsForExtent, colNames)
         else:
-            points = self.driver.readPointsForRange(colNames)
+            points = self._readCached(key,
+                        self.driver.readPointsForRange, colNames)
         return points
-        
+
     def getPulses(self, colNames=None, pulseIndex=None):
         """
         Returns the pulses for the extent/range of the current
@@ -329,18 +399,21 @@ class LidarData(object):
 
         colNames can be a name or list of column names to return. By default
         all columns are returned.
-        
+
         pulseIndex is an optional masked 3d array of indices to remap the
         1d pulse array to a 3D point by bin array. pulseIndex is returned from
         getPointsByBins with returnPulseIndex=True.
         """
+        key = ('pulses', self._makeColNamesKey(colNames))
         if self.controls.spatialProcessing:
-            pulses = self.driver.readPulsesForExtent(colNames)
+            pulses = self._readCached(key,
+                        self.driver.readPulsesForExtent, colNames)
             if pulseIndex is not None:
                 pulses = numpy.ma.array(pulses[pulseIndex], mask=pulseIndex.mask)
         else:
-            pulses = self.driver.readPulsesForRange(colNames)              
-        
+            pulses = self._readCached(key,
+                        self.driver.readPulsesForRange, colNames)
+
         return pulses
         
     def getPulsesByBins(self, extent=None, colNames=None):
@@ -363,12 +436,39 @@ class LidarData(object):
         all columns are returned.
         """
         if self.controls.spatialProcessing:
-            pulses = self.driver.readPulsesForExtentByBins(extent, colNames)
+            if extent is None:
+                key = ('pulsesbybins', self._makeColNamesKey(colNames))
+                pulses = self._readCached(key,
+                            self.driver.readPulsesForExtentByBins, extent,
+                            colNames)
+            else:
+                # override extents aren't cached - the same extent object
+                # could be mutated between calls
+                pulses = self.driver.readPulsesForExtentByBins(extent, colNames)
         else:
             msg = 'Call only valid when doing spatial processing'
             raise generic.LiDARNonSpatialProcessing(msg)
-            
+
         return pulses
+
+    def getPulsesByBinsField(self, name, extent=None):
+        """
+        Returns a single column of the binned pulses as a contiguous
+        non-structured masked array. Reductions over the bins (eg
+        pulsesByBins.mean(axis=0)) then run over packed memory instead of
+        striding through the full pulse records, which matters once the
+        pulse dtype gets large.
+
+        name is a single column name. The extent/binning can be overriden
+        by passing a basedriver.Extent instance.
+        """
+        if extent is None:
+            # goes through the per-block field cache
+            return self.getField(name, kind='pulsesbybins')
+
+        pulses = self.getPulsesByBins(extent=extent, colNames=name)
+        return numpy.ma.MaskedArray(numpy.ascontiguousarray(pulses.data),
+            mask=pulses.mask)
         
     def getPointsByBins(self, extent=None, colNames=None, indexByPulse=False,
                 returnPulseIndex=False):
@@ -397,61 +497,293 @@ class LidarData(object):
         containing the indexes into the 1d array returned by getPulses().
         """
         if self.controls.spatialProcessing:
-            points = self.driver.readPointsForExtentByBins(extent, colNames, 
+            if extent is None:
+                key = ('pointsbybins', self._makeColNamesKey(colNames),
                         indexByPulse, returnPulseIndex)
+                points = self._readCached(key,
+                            self.driver.readPointsForExtentByBins, extent,
+                            colNames, indexByPulse, returnPulseIndex)
+            else:
+                # override extents aren't cached - the same extent object
+                # could be mutated between calls
+                points = self.driver.readPointsForExtentByBins(extent,
+                            colNames, indexByPulse, returnPulseIndex)
         else:
             msg = 'Call only valid when doing spatial processing'
             raise generic.LiDARNonSpatialProcessing(msg)
 
         return points
     
-    def rebinPtsByHeight(self, pointsByBin, bins, heightArray=None, heightField='Z'):
+    def getField(self, name, kind='points'):
+        """
+        Returns a single column for the current block as a contiguous
+        (possibly masked) non-structured array. kind is one of 'points',
+        'pulses', 'pointsbybins' or 'pulsesbybins' and selects which of
+        the get* functions is used to do the read.
+
+        The extracted field is cached so repeated requests for the same
+        column within a block don't re-read the data or pay the
+        structured-view extraction cost again. The cache is dropped at the
+        end of each block (in flush()).
+        """
+        key = (kind, name)
+        if key in self._fieldCache:
+            return self._fieldCache[key]
+
+        if kind == 'points':
+            field = self.getPoints(colNames=name)
+        elif kind == 'pulses':
+            field = self.getPulses(colNames=name)
+        elif kind == 'pointsbybins':
+            field = self.getPointsByBins(colNames=name)
+        elif kind == 'pulsesbybins':
+            field = self.getPulsesByBins(colNames=name)
+        else:
+            msg = "kind must be one of 'points', 'pulses', " \
+                "'pointsbybins' or 'pulsesbybins'"
+            raise generic.LiDARInvalidSetting(msg)
+
+        if isinstance(field, numpy.ma.MaskedArray):
+            field = numpy.ma.MaskedArray(
+                numpy.ascontiguousarray(field.data), mask=field.mask)
+        else:
+            field = numpy.ascontiguousarray(field)
+
+        self._fieldCache[key] = field
+        return field
+
+    def _getRebinScratch(self, name, size, dtype=numpy.int64):
+        """
+        Return a 1d scratch array of at least 'size' elements with
+        uninitialised contents. Buffers are kept on the instance and only
+        grown (by 1.5x) when a block needs more, so processing many
+        similarly sized blocks does not reallocate every call.
+        """
+        arr = self._rebinScratch.get(name)
+        if arr is None or arr.size < size or arr.dtype != dtype:
+            arr = numpy.empty(int(size * 1.5) + 1, dtype=dtype)
+            self._rebinScratch[name] = arr
+        return arr[:size]
+
+    def _stratifyPtsByHeight(self, heightArray, bins):
+        """
+        Shared first stage of rebinPtsByHeight() and rebinAndReduce().
+        Assigns each valid point to a height bin and returns
+        (idx_p, idx_row, idx_col, ptBins, flatIdx) for the valid in-range
+        points, where flatIdx is the flattened (bin, row, col) index.
+        flatIdx lives in a reused scratch buffer so is only valid until
+        the next call.
+        """
+        (npts, nrows, ncols) = heightArray.shape
+        nbins = len(bins) - 1
+
+        # hoist the heights out of the structured view into a contiguous
+        # array once - everything below then reads packed memory rather
+        # than striding through the point records
+        heightData = numpy.ascontiguousarray(heightArray.data)
+
+        # searchsorted with side='right' gives the same bin assignment as
+        # the old numba kernel - bins[b] <= v < bins[b+1]
+        binIdx = numpy.searchsorted(bins, heightData, side='right') - 1
+        (idx_p, idx_row, idx_col) = numpy.nonzero(~heightArray.mask)
+        ptBins = binIdx[idx_p, idx_row, idx_col]
+        # points outside the range of the bins are dropped,
+        # same as the kernel behaviour
+        inRange = (ptBins >= 0) & (ptBins < nbins)
+        idx_p = idx_p[inRange]
+        idx_row = idx_row[inRange]
+        idx_col = idx_col[inRange]
+        ptBins = ptBins[inRange]
+
+        # the flat index goes into a reused scratch buffer so repeated
+        # blocks don't pay an allocation + first-touch fault each time
+        flatIdx = self._getRebinScratch('flatIdx', ptBins.size)
+        numpy.multiply(ptBins, nrows, out=flatIdx)
+        flatIdx += idx_row
+        flatIdx *= ncols
+        flatIdx += idx_col
+
+        return idx_p, idx_row, idx_col, ptBins, flatIdx
+
+    def rebinAndReduce(self, pointsByBin, bins, fields=None, op='mean',
+            heightArray=None, heightField='Z'):
+        """
+        Stratify pointsByBin by height like rebinPtsByHeight(), but reduce
+        along the points axis in the same pass instead of materializing
+        the full 4d output. Most callers immediately reduce the rebinned
+        array, and the 4d intermediate is by far the largest array in
+        that workflow - fusing the reduction avoids it entirely.
+
+        * pointsByBin   3d ragged (masked) structured array of points as
+          for rebinPtsByHeight()
+        * bins          height bins, as for rebinPtsByHeight()
+        * fields        column name or list of column names to reduce. By
+          default all columns. Ignored when op is 'count'.
+        * op            one of 'mean', 'sum' or 'count'
+        * heightArray/heightField as for rebinPtsByHeight()
+
+        Returns a 3d (nbins, nrows, ncols) masked array per field (masked
+        where a bin holds no points) - as a dict keyed on field name, or
+        the array itself if fields was a single name or op was 'count'.
+        'mean' and 'sum' are computed in float64.
+        """
+        (maxpts, nrows, ncols) = pointsByBin.shape
+        nbins = len(bins) - 1
+        if heightArray is None:
+            heightArray = pointsByBin[heightField]
+
+        (idx_p, idx_row, idx_col, ptBins, flatIdx) = (
+            self._stratifyPtsByHeight(heightArray, bins))
+        counts = numpy.bincount(flatIdx,
+            minlength=nbins * nrows * ncols).reshape((nbins, nrows, ncols))
+        empty = counts == 0
+
+        if op == 'count':
+            return numpy.ma.MaskedArray(counts, mask=empty)
+        elif op not in ('mean', 'sum'):
+            msg = "op must be one of 'mean', 'sum' or 'count'"
+            raise generic.LiDARInvalidSetting(msg)
+
+        single = False
+        if fields is None:
+            fields = list(pointsByBin.dtype.names)
+        elif isinstance(fields, str):
+            fields = [fields]
+            single = True
+
+        results = {}
+        for name in fields:
+            vals = pointsByBin.data[name][idx_p, idx_row, idx_col]
+            sums = numpy.bincount(flatIdx, weights=vals,
+                minlength=nbins * nrows * ncols).reshape((nbins, nrows, ncols))
+            if op == 'mean':
+                numpy.divide(sums, counts, out=sums, where=~empty)
+            results[name] = numpy.ma.MaskedArray(sums, mask=empty)
+
+        if single:
+            return results[fields[0]]
+        return results
+
+    def rebinPtsByHeight(self, pointsByBin, bins, heightArray=None, heightField='Z',
+            packMask=False):
         """
         pointsByBin       3d ragged (masked) structured array of points. (nrows, ncols, npts)
         bins              Height bins into which to stratify points
-        
-        Set heightArray to a masked array of values used to vertically stratify the points. 
+
+        Set heightArray to a masked array of values used to vertically stratify the points.
         This allows columns not in pointsByBin to be used.
-        
-        Set heightField to specify which pointsByBin column name to use for height values. 
+
+        Set heightField to specify which pointsByBin column name to use for height values.
         Only used if heightArray is None.
-        
+
+        Set packMask to True to have the returned mask packed 8-flags-per-byte
+        along the last axis (numpy.packbits) which uses 1/8th the memory of
+        the full bool mask - useful for large extents where the caller only
+        needs the mask occasionally. Recover the bool mask with
+        numpy.unpackbits(packedMask, axis=-1, count=ncols).
+
         Return:
-            4d re-binned copy of pointsByBin
-            
+            (data, mask) tuple. data is a 4d re-binned copy of pointsByBin
+            and mask is the matching 4d bool array, True where invalid.
+
+        Returning the pair avoids numpy.ma wrapping overhead on all the
+        downstream arithmetic - use rebinPtsByHeightMasked() if you want
+        a masked array.
+
         """
         (maxpts, nrows, ncols) = pointsByBin.shape
         nbins = len(bins) - 1
-        # Set up for first pass
-        idxCount = numpy.zeros((nbins, nrows, ncols), dtype=numpy.uint16)
         if heightArray is None:
             heightArray = pointsByBin[heightField]
-        
-        # numba doesn't support None so create some empty arrays
-        # for the outputs we don't need
-        idxMask = numpy.ones((1, 1, 1, 1), dtype=numpy.bool)
-        rebinnedPts = numpy.empty((1, 1, 1, 1), dtype=pointsByBin.data.dtype)
-        
-        # this first call we are just working out the sizes by letting
-        # it populate idxCount and nothing else
-        stratify3DArrayByValue(pointsByBin.data, heightArray.mask, rebinnedPts,
-            idxMask, idxCount, bins, True, heightArray.data)
+
+        (idx_p, idx_row, idx_col, ptBins, flatIdx) = (
+            self._stratifyPtsByHeight(heightArray, bins))
+        nValid = ptBins.size
+        idxCount = numpy.bincount(flatIdx, minlength=nbins * nrows * ncols)
         ptsPerHgtBin = idxCount.max()
-        
-        # ok now we know the sizes we can create the arrays
-        idxMask = numpy.ones((ptsPerHgtBin, nbins, nrows, ncols), dtype=numpy.bool)
+
+        # ok now we know the sizes we can create the arrays.
+        # rebinnedPts is numpy.empty since every valid slot gets written
+        # and invalid slots are never read (idxMask is True there) - no
+        # point paying for a zero fill. The mask init with full() is a
+        # straight memset.
+        idxMask = numpy.full((ptsPerHgtBin, nbins, nrows, ncols), True)
         rebinnedPts = numpy.empty((ptsPerHgtBin, nbins, nrows, ncols), dtype=pointsByBin.data.dtype)
-        # rezero the counts
-        idxCount.fill(0)
 
-        # now we can call the thing for real
-        stratify3DArrayByValue(pointsByBin.data, heightArray.mask, rebinnedPts, 
-            idxMask, idxCount, bins, False, heightArray.data)
-            
-        # create a masked array
-        rebinnedPtsMasked = numpy.ma.array(rebinnedPts, mask=idxMask)
-        return rebinnedPtsMasked
-        
+        # sort the valid points by (bin, row, col). The position of each
+        # point along the first output axis is then just its offset within
+        # its group, derived from the cumulative counts. This fills the
+        # output in a single pass over the data rather than a second
+        # trip through the kernel.
+        order = numpy.argsort(flatIdx, kind='stable')
+        sortedFlat = self._getRebinScratch('sortedFlat', nValid)
+        numpy.take(flatIdx, order, out=sortedFlat)
+        groupStart = numpy.cumsum(idxCount) - idxCount
+        slot = self._getRebinScratch('slot', nValid)
+        numpy.take(groupStart, sortedFlat, out=slot)
+        # 0..n-1 sequence kept around too since arange can't fill in place
+        arangeBuf = self._rebinScratch.get('arange')
+        if arangeBuf is None or arangeBuf.size < nValid:
+            arangeBuf = numpy.arange(int(nValid * 1.5) + 1, dtype=numpy.int64)
+            self._rebinScratch['arange'] = arangeBuf
+        numpy.subtract(arangeBuf[:nValid], slot, out=slot)
+
+        idx_p = idx_p[order]
+        idx_row = idx_row[order]
+        idx_col = idx_col[order]
+        ptBins = ptBins[order]
+
+        # copy the records across as raw bytes. Fancy indexing a structured
+        # array goes through numpy's generic per-item copy machinery which
+        # is very slow for large dtypes - a gather on a 2d uint8 view of
+        # the same memory is a straight memcpy per record.
+        srcData = numpy.ascontiguousarray(pointsByBin.data)
+        itemsize = srcData.dtype.itemsize
+        srcBytes = srcData.view(numpy.uint8).reshape(
+            (maxpts * nrows * ncols, itemsize))
+        outBytes = rebinnedPts.view(numpy.uint8).reshape(
+            (ptsPerHgtBin * nbins * nrows * ncols, itemsize))
+        srcFlat = self._getRebinScratch('srcFlat', nValid)
+        numpy.multiply(idx_p, nrows, out=srcFlat)
+        srcFlat += idx_row
+        srcFlat *= ncols
+        srcFlat += idx_col
+        dstFlat = self._getRebinScratch('dstFlat', nValid)
+        numpy.multiply(slot, nbins, out=dstFlat)
+        dstFlat += ptBins
+        dstFlat *= nrows
+        dstFlat += idx_row
+        dstFlat *= ncols
+        dstFlat += idx_col
+        # do the scatter in destination order. The destinations of
+        # group-sorted points jump between slots all over the 4d output -
+        # sorting them first means the writes walk the output (and its TLB
+        # pages) sequentially, which is worth the extra argsort
+        dstOrder = numpy.argsort(dstFlat, kind='stable')
+        dstSorted = self._getRebinScratch('dstSorted', nValid)
+        numpy.take(dstFlat, dstOrder, out=dstSorted)
+        srcSorted = self._getRebinScratch('srcSorted', nValid)
+        numpy.take(srcFlat, dstOrder, out=srcSorted)
+        outBytes[dstSorted] = srcBytes[srcSorted]
+        idxMask.reshape(-1)[dstSorted] = False
+
+        if packMask:
+            return rebinnedPts, numpy.packbits(idxMask, axis=-1)
+
+        return rebinnedPts, idxMask
+
+    def rebinPtsByHeightMasked(self, pointsByBin, bins, heightArray=None,
+            heightField='Z'):
+        """
+        Same as rebinPtsByHeight() but returns the result as a single 4d
+        masked array. Provided for code that does its downstream maths
+        with numpy.ma - note that masked arrays add Python overhead to
+        every subsequent operation.
+        """
+        (rebinnedPts, idxMask) = self.rebinPtsByHeight(pointsByBin, bins,
+                heightArray=heightArray, heightField=heightField)
+        return numpy.ma.array(rebinnedPts, mask=idxMask)
+
     def getPointsByPulse(self, colNames=None):
         """
         Returns the points as a 2d structured masked array. The first axis
@@ -712,20 +1044,142 @@ class LidarData(object):
         self.pulsesToWrite = self.convertToStructIfNeeded(pulses, colName,
                                     self.pulsesToWrite)
         
+    def _canBatchWrite(self):
+        """
+        Is the data queued for this block suitable for write batching?
+        Only plain 1d pulses (with optional 2d points-by-pulse) for a
+        file created in non-spatial mode can be combined across blocks.
+        """
+        if (self.controls.writeBatchSize <= 0 or
+                self.mode != generic.CREATE or
+                self.controls.spatialProcessing):
+            return False
+        if (self.transmittedToWrite is not None or
+                self.receivedToWrite is not None or
+                self.waveformInfoToWrite is not None):
+            return False
+        if (self.pulsesToWrite is None or self.pulsesToWrite.ndim != 1 or
+                isinstance(self.pulsesToWrite, numpy.ma.MaskedArray)):
+            return False
+        if self.pointsToWrite is not None and self.pointsToWrite.ndim != 2:
+            return False
+        return True
+
+    @staticmethod
+    def _concatPointsByPulse(arrList):
+        """
+        Concatenate a list of 2d masked points-by-pulse arrays along the
+        pulse axis, padding the points axis out to the deepest pulse.
+        """
+        maxPts = 0
+        nPulses = 0
+        for arr in arrList:
+            maxPts = max(maxPts, arr.shape[0])
+            nPulses += arr.shape[1]
+
+        data = numpy.empty((maxPts, nPulses), dtype=arrList[0].dtype)
+        mask = numpy.full((maxPts, nPulses), True)
+        n = 0
+        for arr in arrList:
+            (nPts, nP) = arr.shape
+            data[:nPts, n:n+nP] = numpy.ma.getdata(arr)
+            mask[:nPts, n:n+nP] = numpy.ma.getmaskarray(arr)
+            n += nP
+
+        return numpy.ma.MaskedArray(data, mask=mask)
+
+    def _flushBatch(self):
+        """
+        Write any output accumulated by write batching and reset.
+        """
+        if len(self._batchedPulses) == 0:
+            return
+
+        pulses = self._batchedPulses[0]
+        if len(self._batchedPulses) > 1:
+            pulses = numpy.concatenate(self._batchedPulses)
+
+        points = None
+        if len(self._batchedPoints) == 1:
+            points = self._batchedPoints[0]
+        elif len(self._batchedPoints) > 1:
+            points = self._concatPointsByPulse(self._batchedPoints)
+
+        self.driver.writeData(pulses, points)
+        self._batchedPulses = []
+        self._batchedPoints = []
+        self._batchedBytes = 0
+
+    def finalFlush(self):
+        """
+        For internal use. Called once by the processor after the last
+        block to write anything still held back by write batching (see
+        Controls.setWriteBatchSize).
+        """
+        self._flushBatch()
+
     def flush(self):
         """
         writes data to file set via the set*() functions
         """
-        self.driver.writeData(self.pulsesToWrite, self.pointsToWrite, 
-            self.transmittedToWrite, self.receivedToWrite, 
+        if self._canBatchWrite():
+            hasPoints = self.pointsToWrite is not None
+            if len(self._batchedPulses) > 0 and hasPoints != self._batchedHasPoints:
+                # blocks with and without points can't share a write -
+                # the points must line up with the pulses of the same call
+                self._flushBatch()
+
+            self._batchedPulses.append(self.pulsesToWrite)
+            self._batchedBytes += self.pulsesToWrite.nbytes
+            if hasPoints:
+                self._batchedPoints.append(self.pointsToWrite)
+                self._batchedBytes += self.pointsToWrite.nbytes
+            self._batchedHasPoints = hasPoints
+
+            self._fieldCache = {}
+            self._blockCache = {}
+            self.pointsToWrite = None
+            self.pulsesToWrite = None
+
+            if self._batchedBytes >= self.controls.writeBatchSize:
+                self._flushBatch()
+            return
+
+        # anything accumulated has to go out first to keep the file in order
+        self._flushBatch()
+
+        self.driver.writeData(self.pulsesToWrite, self.pointsToWrite,
+            self.transmittedToWrite, self.receivedToWrite,
             self.waveformInfoToWrite)
         # reset for next time
+        self._fieldCache = {}
+        self._blockCache = {}
         self.pointsToWrite = None
         self.pulsesToWrite = None
         self.receivedToWrite = None
         self.transmittedToWrite = None
         self.waveformInfoToWrite = None
-        
+
+    def popWriteData(self):
+        """
+        For internal use. Removes and returns the data queued by the set*()
+        functions (as the tuple of arguments for the driver's writeData)
+        and resets for the next block, without doing the write. Used by the
+        processor when writes are being done on a background thread.
+        """
+        data = (self.pulsesToWrite, self.pointsToWrite,
+            self.transmittedToWrite, self.receivedToWrite,
+            self.waveformInfoToWrite)
+        self._fieldCache = {}
+        self._blockCache = {}
+        self.pointsToWrite = None
+        self.pulsesToWrite = None
+        self.receivedToWrite = None
+        self.transmittedToWrite = None
+        self.waveformInfoToWrite = None
+        return data
+
+
 class ImageData(object):
     """
     Class that allows reading and writing to/from an image file. Passed to the 
@@ -759,4 +1213,21 @@ class ImageData(object):
         """
         self.driver.setData(self.data)
         self.data = None
+
+    def popWriteData(self):
+        """
+        For internal use. Removes and returns the data queued by setData()
+        and resets for the next block, without doing the write. Used by the
+        processor when writes are being done on a background thread.
+        """
+        data = self.data
+        self.data = None
+        return data
+
+    def finalFlush(self):
+        """
+        For internal use. Nothing to do for images - image data is
+        never held back by write batching.
+        """
+        pass
         